@@ -9,26 +9,72 @@ Author: Hồ Mạnh Linh
 import requests
 import json
 import time
+import uuid
 import logging
-from typing import Dict, Any, Optional, Tuple
-from urllib.parse import urljoin
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Any, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+from websockets.sync.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+from .utils import create_http_session
 
 logger = logging.getLogger(__name__)
 
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# WebSocket keepalive: a ping every WS_PING_INTERVAL seconds; the connection
+# is treated as dead if no pong arrives within WS_PING_TIMEOUT seconds
+WS_PING_INTERVAL = 10
+WS_PING_TIMEOUT = 10
+
+
+class _PendingPrompt:
+    """Execution state of a queued prompt, filled in by the WebSocket reader"""
+    
+    def __init__(self):
+        self.future: Future = Future()
+        self.outputs: Dict[str, Any] = {}
+        self.on_output: Optional[Callable[[str, Dict[str, Any]], None]] = None
+
 
 class ComfyUIClient:
     """Client for interacting with ComfyUI API"""
     
-    def __init__(self, base_url: str = "http://127.0.0.1:8188"):
+    def __init__(
+        self,
+        base_url: str = "http://127.0.0.1:8188",
+        polling_fallback: bool = True
+    ):
         """
         Initialize ComfyUI client
         
         Args:
             base_url: Base URL of ComfyUI server
+            polling_fallback: Poll prompt history when the WebSocket is
+                unavailable instead of failing the prompt
         """
         self.base_url = base_url.rstrip('/')
-        self.session = requests.Session()
-        logger.info(f"ComfyUI client initialized with base_url: {self.base_url}")
+        self.client_id = "runpod_handler"
+        self.polling_fallback = polling_fallback
+        self.session = create_http_session()
+        self._ws = None
+        self._ws_thread: Optional[threading.Thread] = None
+        self._pending: Dict[str, _PendingPrompt] = {}
+        self._lock = threading.Lock()
+        logger.info("ComfyUI client initialized with base_url: %s", self.base_url)
     
     def _make_request(
         self,
@@ -45,32 +91,160 @@ class ComfyUIClient:
             method: HTTP method (GET, POST, etc.)
             endpoint: API endpoint
             data: Form data
-            json_data: JSON data
+            json_data: JSON data (serialized with orjson when available)
             timeout: Request timeout in seconds
             
         Returns:
             Response object
         """
         url = urljoin(self.base_url, endpoint)
+        headers = None
+        
+        if json_data is not None:
+            data = _json_dumps(json_data)
+            headers = JSON_HEADERS
         
         try:
             response = self.session.request(
                 method=method,
                 url=url,
                 data=data,
-                json=json_data,
+                headers=headers,
                 timeout=timeout
             )
             response.raise_for_status()
             return response
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed: {method} {url} - {e}")
+            logger.error("Request failed: %s %s - %s", method, url, e)
             raise
     
+    def _get_ws_url(self) -> str:
+        """
+        Build the WebSocket URL for this client's event stream
+        
+        Returns:
+            WebSocket URL including the client ID
+        """
+        parts = urlsplit(self.base_url)
+        scheme = 'wss' if parts.scheme == 'https' else 'ws'
+        return f"{scheme}://{parts.netloc}/ws?clientId={self.client_id}"
+    
+    def _connect_websocket(self) -> None:
+        """
+        Open the shared WebSocket event stream if it is not already open
+        
+        One connection and one reader thread serve every prompt queued by
+        this client. Failures are logged and leave the client in polling mode.
+        """
+        with self._lock:
+            if self._ws is not None:
+                return
+            
+            try:
+                self._ws = ws_connect(
+                    self._get_ws_url(),
+                    max_size=None,
+                    ping_interval=WS_PING_INTERVAL,
+                    ping_timeout=WS_PING_TIMEOUT
+                )
+            except (OSError, WebSocketException) as e:
+                logger.warning("WebSocket connection failed, falling back to polling: %s", e)
+                self._ws = None
+                return
+            
+            self._ws_thread = threading.Thread(
+                target=self._read_websocket,
+                args=(self._ws,),
+                name="comfyui-ws-reader",
+                daemon=True
+            )
+            self._ws_thread.start()
+            logger.info("ComfyUI WebSocket connected")
+    
+    def _read_websocket(self, ws) -> None:
+        """
+        Route WebSocket events to pending prompts until the connection closes
+        
+        Prompts still pending when the connection drops are failed with
+        ConnectionClosed so their waiters fall back to polling.
+        
+        Args:
+            ws: Connected WebSocket
+        """
+        error: Exception = ConnectionError("ComfyUI WebSocket closed")
+        try:
+            for message in ws:
+                # Binary frames carry preview images
+                if isinstance(message, str):
+                    self._dispatch(_json_loads(message))
+        except ConnectionClosed as e:
+            # Also raised when a keepalive ping goes unanswered
+            logger.warning("WebSocket closed: %s", e)
+            error = e
+        except Exception as e:
+            logger.exception("WebSocket reader failed")
+            error = e
+        
+        with self._lock:
+            if self._ws is ws:
+                self._ws = None
+            pending = list(self._pending.values())
+        
+        for entry in pending:
+            if not entry.future.done():
+                entry.future.set_exception(error)
+    
+    def _dispatch(self, event: Dict[str, Any]) -> None:
+        """
+        Apply a single WebSocket event to the prompt it belongs to
+        
+        Args:
+            event: Decoded WebSocket message
+        """
+        msg_type = event.get('type')
+        data = event.get('data') or {}
+        
+        with self._lock:
+            entry = self._pending.get(data.get('prompt_id'))
+        
+        if entry is None or entry.future.done():
+            return
+        
+        if msg_type == 'progress':
+            logger.debug("Progress: %s/%s (node: %s)", data.get('value'), data.get('max'), data.get('node'))
+        
+        elif msg_type == 'executing':
+            if data.get('node') is None:
+                entry.future.set_result((True, {"outputs": entry.outputs}))
+            else:
+                logger.debug("Executing node %s", data['node'])
+        
+        elif msg_type == 'executed':
+            output = data.get('output') or {}
+            with self._lock:
+                entry.outputs[data['node']] = output
+                on_output = entry.on_output
+            if on_output:
+                try:
+                    on_output(data['node'], output)
+                except Exception:
+                    logger.exception("on_output callback failed")
+        
+        elif msg_type == 'execution_error':
+            error_msg = data.get('exception_message', 'Execution error')
+            entry.future.set_result((False, {"error": error_msg}))
+        
+        elif msg_type == 'execution_interrupted':
+            entry.future.set_result((False, {"error": "Execution interrupted"}))
+    
     def queue_prompt(self, workflow: Dict[str, Any]) -> str:
         """
         Queue a workflow for execution
         
+        The prompt ID is chosen client-side and registered with the
+        WebSocket reader before the request is sent, so no execution
+        events are missed.
+        
         Args:
             workflow: ComfyUI workflow dictionary
             
@@ -79,25 +253,45 @@ class ComfyUIClient:
         """
         logger.info("Queueing workflow...")
         
+        self._connect_websocket()
+        
+        prompt_id = uuid.uuid4().hex
+        entry = _PendingPrompt()
+        with self._lock:
+            if self._ws is not None:
+                self._pending[prompt_id] = entry
+        
         payload = {
             "prompt": workflow,
-            "client_id": "runpod_handler"
+            "client_id": self.client_id,
+            "prompt_id": prompt_id
         }
         
-        response = self._make_request(
-            method="POST",
-            endpoint="/prompt",
-            json_data=payload
-        )
-        
-        result = response.json()
-        prompt_id = result.get('prompt_id')
+        try:
+            response = self._make_request(
+                method="POST",
+                endpoint="/prompt",
+                json_data=payload
+            )
+            
+            result = response.json()
+            queued_id = result.get('prompt_id')
+            
+            if not queued_id:
+                raise ValueError("No prompt_id returned from ComfyUI")
+        except BaseException:
+            with self._lock:
+                self._pending.pop(prompt_id, None)
+            raise
         
-        if not prompt_id:
-            raise ValueError("No prompt_id returned from ComfyUI")
+        # Older ComfyUI versions ignore the client-supplied ID
+        if queued_id != prompt_id:
+            with self._lock:
+                if self._pending.pop(prompt_id, None) is not None:
+                    self._pending[queued_id] = entry
         
-        logger.info(f"Workflow queued successfully: {prompt_id}")
-        return prompt_id
+        logger.info("Workflow queued successfully: %s", queued_id)
+        return queued_id
     
     def get_history(self, prompt_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -117,27 +311,117 @@ class ComfyUIClient:
         history = response.json()
         return history.get(prompt_id)
     
-    def get_queue(self) -> Dict[str, Any]:
+    def wait_for_completion(
+        self,
+        prompt_id: str,
+        timeout: int = 300,
+        check_interval: int = 2,
+        on_output: Optional[Callable[[str, Dict[str, Any]], None]] = None
+    ) -> Tuple[bool, Dict[str, Any]]:
         """
-        Get current queue status
+        Wait for workflow completion
         
+        Waits for the shared WebSocket reader to resolve the prompt; node
+        outputs are collected from 'executed' messages. History is only
+        fetched if no outputs were reported. If the prompt is not tracked
+        over the WebSocket or the connection drops, history is polled when
+        polling_fallback is enabled; otherwise the prompt fails.
+        
+        Args:
+            prompt_id: Prompt ID to monitor
+            timeout: Maximum wait time in seconds
+            check_interval: Seconds between status checks (polling fallback only)
+            on_output: Optional callback invoked with (node_id, output) as soon
+                as a node reports its output over the WebSocket
+            
         Returns:
-            Queue information
+            Tuple of (success: bool, result: dict)
         """
-        response = self._make_request(
-            method="GET",
-            endpoint="/queue"
-        )
-        return response.json()
+        with self._lock:
+            entry = self._pending.get(prompt_id)
+            if entry is not None:
+                entry.on_output = on_output
+                delivered = list(entry.outputs.items())
+        
+        if entry is None:
+            return self._fall_back(prompt_id, timeout, check_interval)
+        
+        # Replay outputs that arrived before the callback was attached
+        if on_output:
+            for node_id, output in delivered:
+                on_output(node_id, output)
+        
+        logger.info("Waiting for prompt %s completion (timeout: %ss)...", prompt_id, timeout)
+        
+        deadline = time.monotonic() + timeout
+        
+        try:
+            success, result = entry.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.error("Timeout waiting for prompt %s", prompt_id)
+            return False, {"error": "Execution timeout"}
+        except (ConnectionClosed, ConnectionError) as e:
+            logger.warning("WebSocket closed while waiting for prompt %s: %s", prompt_id, e)
+            remaining = max(deadline - time.monotonic(), 0)
+            return self._fall_back(prompt_id, remaining, check_interval)
+        finally:
+            with self._lock:
+                self._pending.pop(prompt_id, None)
+        
+        if not success:
+            logger.error("Workflow error: %s", result['error'])
+            return False, result
+        
+        # Outputs were already delivered by 'executed' events
+        if result['outputs']:
+            logger.info("Workflow completed successfully")
+            return True, result
+        
+        history = self.get_history(prompt_id)
+        
+        if not history:
+            logger.error("No history for completed prompt %s", prompt_id)
+            return False, {"error": "No execution history found"}
+        
+        if 'error' in history:
+            error_msg = history['error']
+            logger.error("Workflow error: %s", error_msg)
+            return False, {"error": error_msg}
+        
+        logger.info("Workflow completed successfully")
+        return True, history
     
-    def wait_for_completion(
+    def _fall_back(
         self,
         prompt_id: str,
-        timeout: int = 300,
-        check_interval: int = 2
+        timeout: float,
+        check_interval: int
     ) -> Tuple[bool, Dict[str, Any]]:
         """
-        Wait for workflow completion
+        Handle a prompt the WebSocket cannot report on
+        
+        Args:
+            prompt_id: Prompt ID to monitor
+            timeout: Maximum wait time in seconds
+            check_interval: Seconds between status checks
+            
+        Returns:
+            Tuple of (success: bool, result: dict)
+        """
+        if self.polling_fallback:
+            return self._poll_for_completion(prompt_id, timeout, check_interval)
+        
+        logger.error("No WebSocket for prompt %s and polling fallback is disabled", prompt_id)
+        return False, {"error": "ComfyUI WebSocket unavailable"}
+    
+    def _poll_for_completion(
+        self,
+        prompt_id: str,
+        timeout: float,
+        check_interval: int
+    ) -> Tuple[bool, Dict[str, Any]]:
+        """
+        Wait for workflow completion by polling history
         
         Args:
             prompt_id: Prompt ID to monitor
@@ -147,15 +431,15 @@ class ComfyUIClient:
         Returns:
             Tuple of (success: bool, result: dict)
         """
-        logger.info(f"Waiting for prompt {prompt_id} completion (timeout: {timeout}s)...")
+        logger.info("Polling prompt %s completion (timeout: %ss)...", prompt_id, timeout)
         
-        start_time = time.time()
+        start_time = time.monotonic()
         
         while True:
-            elapsed = time.time() - start_time
+            elapsed = time.monotonic() - start_time
             
             if elapsed > timeout:
-                logger.error(f"Timeout waiting for prompt {prompt_id}")
+                logger.error("Timeout waiting for prompt %s", prompt_id)
                 return False, {"error": "Execution timeout"}
             
             # Check history
@@ -165,32 +449,16 @@ class ComfyUIClient:
                 # Check for errors
                 if 'error' in history:
                     error_msg = history['error']
-                    logger.error(f"Workflow error: {error_msg}")
+                    logger.error("Workflow error: %s", error_msg)
                     return False, {"error": error_msg}
                 
                 # Check if completed
                 status = history.get('status', {})
                 if status.get('status_str') == 'success' or 'outputs' in history:
-                    logger.info(f"Workflow completed successfully")
+                    logger.info("Workflow completed successfully")
                     return True, history
             
-            # Check queue
-            queue_info = self.get_queue()
-            queue_running = queue_info.get('queue_running', [])
-            queue_pending = queue_info.get('queue_pending', [])
-            
-            # Check if our prompt is in queue
-            in_queue = any(
-                item[1] == prompt_id 
-                for item in queue_running + queue_pending
-            )
-            
-            if not in_queue and not history:
-                logger.warning(f"Prompt {prompt_id} not in queue and no history")
-                time.sleep(check_interval)
-                continue
-            
-            logger.debug(f"Still processing... (elapsed: {elapsed:.1f}s)")
+            logger.debug("Still processing... (elapsed: %.1fs)", elapsed)
             time.sleep(check_interval)
     
     def interrupt(self) -> None:
@@ -228,5 +496,5 @@ class ComfyUIClient:
             logger.info("ComfyUI health check: OK")
             return True
         except Exception as e:
-            logger.error(f"ComfyUI health check failed: {e}")
+            logger.error("ComfyUI health check failed: %s", e)
             return False
\ No newline at end of file
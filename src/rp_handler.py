@@ -7,21 +7,35 @@ License: MIT
 """
 
 import runpod
+import asyncio
+import contextlib
 import os
 import json
+import stat
 import time
 import logging
-from typing import Dict, Any, Optional
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Any, List, Optional, Tuple
 from pathlib import Path
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 from .comfyui_api import ComfyUIClient
 from .storage import S3StorageManager
 from .utils import (
     download_file,
+    download_file_cached,
     validate_input,
     get_duration_from_audio,
     calculate_num_frames,
-    setup_logging
+    get_default_session,
+    setup_logging,
+    summarize_input
 )
 
 # Setup logging
@@ -34,14 +48,230 @@ WORKSPACE_DIR = Path('/workspace')
 OUTPUT_DIR = WORKSPACE_DIR / 'output'
 INPUT_DIR = WORKSPACE_DIR / 'input'
 WORKFLOW_PATH = WORKSPACE_DIR / 'workflows' / 'ltx2_i2v_lipsync.json'
+CACHE_DIR = INPUT_DIR / 'cache'
+CACHE_REFERENCE_IMAGES = os.getenv('CACHE_REFERENCE_IMAGES', 'false').lower() == 'true'
+COMFYUI_POLLING_FALLBACK = os.getenv('COMFYUI_POLLING_FALLBACK', 'true').lower() == 'true'
+MAX_CONCURRENT_JOBS = max(1, int(os.getenv('MAX_CONCURRENT_JOBS', '1')))
+
+# Per-job file name and S3 key templates
+AUDIO_FILENAME_FMT = '%s_audio.mp3'
+REFERENCE_FILENAME_FMT = '%s_reference.jpg'
+S3_VIDEO_KEY_FMT = 'videos/%s/%s'
 
 # Create directories
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 INPUT_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 # Initialize clients
-comfyui_client = ComfyUIClient(COMFYUI_URL)
+comfyui_client = ComfyUIClient(COMFYUI_URL, polling_fallback=COMFYUI_POLLING_FALLBACK)
 s3_manager = S3StorageManager(bucket_name=S3_BUCKET)
+http_session = get_default_session()
+
+# Background executors for input downloads, S3 uploads and removing temporary files
+_download_executor = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_JOBS)
+_upload_executor = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_JOBS)
+_cleanup_executor = ThreadPoolExecutor(max_workers=1)
+
+# Concurrent jobs (MAX_CONCURRENT_JOBS > 1) run on _job_executor and share one GPU slot
+_job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+_gpu_slot = threading.Semaphore(1)
+
+
+def _set_prompt(inputs: Dict[str, Any], params: Dict[str, Any]) -> None:
+    """Set the text prompt (Flux)"""
+    inputs['text'] = params['prompt']
+
+
+def _set_video_params(inputs: Dict[str, Any], params: Dict[str, Any]) -> None:
+    """Set the LTX-2 video parameters"""
+    inputs.update(params['video'])
+
+
+def _set_audio(inputs: Dict[str, Any], params: Dict[str, Any]) -> None:
+    """Set the audio path"""
+    inputs['audio'] = params['audio']
+
+
+def _set_reference_image(inputs: Dict[str, Any], params: Dict[str, Any]) -> None:
+    """Set the reference image path if one was provided"""
+    if params['image']:
+        inputs['image'] = params['image']
+
+
+# Job parameter writers by node class_type; every type must exist in the workflow
+NODE_UPDATERS = {
+    'CLIPTextEncode': _set_prompt,
+    'LTX2VideoGeneration': _set_video_params,
+    'LoadAudio': _set_audio,
+    'LoadImage': _set_reference_image
+}
+REQUIRED_NODE_TYPES = tuple(NODE_UPDATERS)
+
+# Workflow template cache: parsed template and node IDs grouped by class_type
+_workflow_template: Optional[Dict[str, Any]] = None
+_workflow_nodes: Dict[str, List[str]] = {}
+_workflow_lock = threading.Lock()
+
+
+def _load_workflow_template() -> Tuple[Dict[str, Any], Dict[str, List[str]]]:
+    """
+    Parse and validate the workflow template once per worker
+    
+    Called from __main__ before the worker starts, so a broken template
+    stops the worker instead of failing every job.
+    
+    Returns:
+        Tuple of (template, node IDs grouped by class_type)
+        
+    Raises:
+        ValueError: If the template lacks a required node type
+    """
+    global _workflow_template, _workflow_nodes
+    
+    if _workflow_template is None:
+        # Concurrent jobs on a cold worker must not rebuild the index under each other
+        with _workflow_lock:
+            if _workflow_template is None:
+                logger.info("Loading workflow from %s", WORKFLOW_PATH)
+                with open(WORKFLOW_PATH, 'rb') as f:
+                    template = _json_loads(f.read())
+                
+                nodes: Dict[str, List[str]] = {}
+                for node_id, node in template.items():
+                    nodes.setdefault(node.get('class_type'), []).append(node_id)
+                
+                missing = [node_type for node_type in REQUIRED_NODE_TYPES if node_type not in nodes]
+                if missing:
+                    raise ValueError(
+                        f"Workflow {WORKFLOW_PATH} is missing node types: {', '.join(missing)}"
+                    )
+                
+                # Publish the index before the template that signals it is ready
+                _workflow_nodes = nodes
+                _workflow_template = template
+    
+    return _workflow_template, _workflow_nodes
+
+
+def _load_workflow() -> Dict[str, Any]:
+    """
+    Load a per-job copy of the ComfyUI workflow
+    
+    Each call returns a shallow copy of the cached template in which only
+    the nodes written by NODE_UPDATERS (and their inputs) are copied; all
+    other nodes are shared read-only with the template.
+    
+    Returns:
+        Workflow dictionary
+        
+    Raises:
+        ValueError: If the template lacks a required node type
+    """
+    template, nodes = _load_workflow_template()
+    workflow = dict(template)
+    for class_type in NODE_UPDATERS:
+        for node_id in nodes[class_type]:
+            node = workflow[node_id]
+            workflow[node_id] = {**node, 'inputs': dict(node['inputs'])}
+    return workflow
+
+
+def _apply_job_params(workflow: Dict[str, Any], params: Dict[str, Any]) -> None:
+    """
+    Write job parameters into the workflow nodes that consume them
+    
+    Only nodes listed in the class_type index are visited.
+    
+    Args:
+        workflow: Workflow dictionary from _load_workflow
+        params: Job parameters keyed as expected by NODE_UPDATERS
+    """
+    for class_type, update in NODE_UPDATERS.items():
+        for node_id in _workflow_nodes[class_type]:
+            update(workflow[node_id]['inputs'], params)
+
+
+def _discard_upload(upload: Future, s3_key: str) -> None:
+    """
+    Stop or undo an S3 upload whose result will not be returned
+    
+    Queued uploads are cancelled; running ones are left to finish on the
+    cleanup executor, which then deletes the uploaded object.
+    
+    Args:
+        upload: Future from _upload_executor
+        s3_key: S3 object key the upload writes to
+    """
+    if upload.cancel():
+        logger.info("Cancelled S3 upload for %s", s3_key)
+        return
+    
+    _cleanup_executor.submit(_delete_upload, upload, s3_key)
+
+
+def _delete_upload(upload: Future, s3_key: str) -> None:
+    """
+    Wait for a discarded S3 upload and delete the object it wrote
+    
+    Args:
+        upload: Future from _upload_executor
+        s3_key: S3 object key the upload writes to
+    """
+    try:
+        upload.result()
+    except Exception as e:
+        logger.warning("Discarded S3 upload for %s failed: %s", s3_key, e)
+        return
+    
+    try:
+        s3_manager.delete_file(s3_key)
+    except Exception as e:
+        logger.warning("Could not delete discarded upload %s: %s", s3_key, e)
+
+
+def _cleanup(*paths: Optional[Path]) -> None:
+    """
+    Remove temporary job files
+    
+    Args:
+        paths: Files to delete (None entries are ignored)
+    """
+    for path in paths:
+        if not path:
+            continue
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+        except OSError as e:
+            logger.warning("Cleanup error: %s", e)
+    logger.info("Temporary files cleaned up")
+
+
+def _get_video_filename(outputs: Dict[str, Any]) -> Optional[str]:
+    """
+    Find the generated video filename in ComfyUI outputs
+    
+    Args:
+        outputs: Outputs dictionary (keyed by node ID) from ComfyUI
+        
+    Returns:
+        Filename relative to OUTPUT_DIR, or None if no video was produced
+    """
+    video = outputs.get('video')
+    if isinstance(video, dict) and video.get('filename'):
+        return video['filename']
+    
+    for node_output in outputs.values():
+        if not isinstance(node_output, dict):
+            continue
+        for key in ('videos', 'gifs'):
+            for item in node_output.get(key) or ():
+                if item.get('filename'):
+                    subfolder = item.get('subfolder') or ''
+                    return str(Path(subfolder) / item['filename'])
+    
+    return None
 
 
 def handler(job: Dict[str, Any]) -> Dict[str, Any]:
@@ -57,10 +287,18 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
     job_input = job.get('input', {})
     job_id = job.get('id', 'unknown')
     
-    logger.info(f"Starting job {job_id}")
-    logger.info(f"Input parameters: {json.dumps(job_input, indent=2)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Starting job %s input=%s", job_id, summarize_input(job_input))
     
     start_time = time.time()
+    audio_path = None
+    reference_image_path = None
+    
+    # S3 uploads by video filename; all but the returned one are discarded
+    uploads: Dict[str, Future] = {}
+    uploads_lock = threading.Lock()
+    uploads_closed = threading.Event()
+    returned_video = None
     
     try:
         # ============================================
@@ -68,7 +306,7 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         # ============================================
         validation_error = validate_input(job_input)
         if validation_error:
-            logger.error(f"Validation error: {validation_error}")
+            logger.error("Validation error: %s", validation_error)
             return {
                 "status": "error",
                 "error": validation_error
@@ -87,83 +325,106 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         seed = job_input.get('seed', -1)
         
         # ============================================
-        # 2. Download Audio & Calculate Frames
+        # 2. Download Audio & Reference Image (concurrently)
         # ============================================
-        logger.info("Downloading audio file...")
-        audio_path = INPUT_DIR / f"{job_id}_audio.mp3"
-        download_file(audio_url, audio_path)
+        logger.info("Downloading input files...")
+        audio_path = INPUT_DIR / (AUDIO_FILENAME_FMT % job_id)
+        downloads = [
+            _download_executor.submit(download_file, audio_url, audio_path, session=http_session)
+        ]
         
-        # Auto-calculate num_frames from audio duration
-        if num_frames is None:
-            audio_duration = get_duration_from_audio(audio_path)
-            num_frames = calculate_num_frames(audio_duration, fps)
-            logger.info(f"Auto-calculated num_frames: {num_frames} (duration: {audio_duration}s, fps: {fps})")
+        if reference_image_url:
+            reference_image_path = INPUT_DIR / (REFERENCE_FILENAME_FMT % job_id)
+            if CACHE_REFERENCE_IMAGES:
+                downloads.append(
+                    _download_executor.submit(
+                        download_file_cached, reference_image_url, reference_image_path,
+                        CACHE_DIR, session=http_session
+                    )
+                )
+            else:
+                downloads.append(
+                    _download_executor.submit(
+                        download_file, reference_image_url, reference_image_path, session=http_session
+                    )
+                )
+        
+        # Let every download settle before surfacing the first failure
+        wait(downloads)
+        for future in downloads:
+            future.result()
         
         # ============================================
-        # 3. Download Reference Image (if provided)
+        # 3. Calculate Frames
         # ============================================
-        reference_image_path = None
-        if reference_image_url:
-            logger.info("Downloading reference image...")
-            reference_image_path = INPUT_DIR / f"{job_id}_reference.jpg"
-            download_file(reference_image_url, reference_image_path)
+        # Auto-calculate num_frames from audio duration
+        audio_duration = get_duration_from_audio(audio_path)
+        if num_frames is None:
+            num_frames = calculate_num_frames(audio_duration, fps)
+            logger.info("Auto-calculated num_frames: %s (duration: %ss, fps: %s)", num_frames, audio_duration, fps)
         
         # ============================================
         # 4. Load ComfyUI Workflow
         # ============================================
-        logger.info(f"Loading workflow from {WORKFLOW_PATH}")
-        with open(WORKFLOW_PATH, 'r', encoding='utf-8') as f:
-            workflow = json.load(f)
+        workflow = _load_workflow()
         
         # ============================================
         # 5. Update Workflow Parameters
         # ============================================
         logger.info("Updating workflow parameters...")
-        
-        # Update text prompt node (Flux)
-        for node_id, node in workflow.items():
-            if node.get('class_type') == 'CLIPTextEncode':
-                node['inputs']['text'] = prompt
-            
-            # Update LTX-2 video parameters
-            elif node.get('class_type') == 'LTX2VideoGeneration':
-                node['inputs'].update({
-                    'num_frames': num_frames,
-                    'width': width,
-                    'height': height,
-                    'cfg_scale': cfg_scale,
-                    'steps': steps,
-                    'seed': seed
-                })
-            
-            # Update audio path
-            elif node.get('class_type') == 'LoadAudio':
-                node['inputs']['audio'] = str(audio_path)
-            
-            # Update reference image if provided
-            elif node.get('class_type') == 'LoadImage' and reference_image_path:
-                node['inputs']['image'] = str(reference_image_path)
+        _apply_job_params(workflow, {
+            'prompt': prompt,
+            'video': {
+                'num_frames': num_frames,
+                'width': width,
+                'height': height,
+                'cfg_scale': cfg_scale,
+                'steps': steps,
+                'seed': seed
+            },
+            'audio': str(audio_path),
+            'image': str(reference_image_path) if reference_image_path else None
+        })
         
         # ============================================
         # 6. Queue Workflow in ComfyUI
         # ============================================
-        logger.info("Queueing workflow in ComfyUI...")
-        prompt_id = comfyui_client.queue_prompt(workflow)
-        logger.info(f"Workflow queued with prompt_id: {prompt_id}")
+        # Start the S3 upload as soon as ComfyUI reports the saved video
+        def _on_output(node_id: str, output: Dict[str, Any]) -> None:
+            filename = _get_video_filename({node_id: output})
+            if not filename or not (OUTPUT_DIR / filename).exists():
+                return
+            # Called from both the WebSocket reader and the replay in wait_for_completion
+            with uploads_lock:
+                if uploads or uploads_closed.is_set():
+                    return
+                logger.info("Starting early S3 upload for %s", filename)
+                uploads[filename] = _upload_executor.submit(
+                    s3_manager.upload_file,
+                    OUTPUT_DIR / filename,
+                    S3_VIDEO_KEY_FMT % (job_id, filename)
+                )
         
-        # ============================================
-        # 7. Wait for Completion
-        # ============================================
-        logger.info("Waiting for workflow completion...")
-        success, result = comfyui_client.wait_for_completion(
-            prompt_id,
-            timeout=300,  # 5 minutes
-            check_interval=2
-        )
+        # Concurrent jobs take turns on the GPU; the timeout starts once the slot is held
+        with _gpu_slot:
+            logger.info("Queueing workflow in ComfyUI...")
+            prompt_id = comfyui_client.queue_prompt(workflow)
+            logger.info("Workflow queued with prompt_id: %s", prompt_id)
+            
+            # ============================================
+            # 7. Wait for Completion
+            # ============================================
+            logger.info("Waiting for workflow completion...")
+            success, result = comfyui_client.wait_for_completion(
+                prompt_id,
+                timeout=300,  # 5 minutes
+                check_interval=2,
+                on_output=_on_output
+            )
         
         if not success:
             error_msg = result.get('error', 'Unknown error during processing')
-            logger.error(f"Workflow failed: {error_msg}")
+            logger.error("Workflow failed: %s", error_msg)
             return {
                 "status": "error",
                 "error": error_msg
@@ -173,7 +434,7 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         # 8. Get Output Video Path
         # ============================================
         logger.info("Retrieving output video...")
-        video_filename = result.get('outputs', {}).get('video', {}).get('filename')
+        video_filename = _get_video_filename(result.get('outputs', {}))
         
         if not video_filename:
             logger.error("No video filename in result")
@@ -184,35 +445,48 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         
         video_path = OUTPUT_DIR / video_filename
         
-        if not video_path.exists():
-            logger.error(f"Video file not found: {video_path}")
+        # One stat serves both the existence check and the file size
+        try:
+            video_stat = os.stat(video_path)
+        except FileNotFoundError:
+            video_stat = None
+        
+        if video_stat is None or not stat.S_ISREG(video_stat.st_mode):
+            logger.error("Video file not found: %s", video_path)
             return {
                 "status": "error",
                 "error": f"Output video not found: {video_filename}"
             }
         
-        # ============================================
-        # 9. Upload to S3
-        # ============================================
-        logger.info(f"Uploading video to S3: {video_path}")
-        s3_key = f"videos/{job_id}/{video_filename}"
-        video_url = s3_manager.upload_file(video_path, s3_key)
-        logger.info(f"Video uploaded successfully: {video_url}")
+        file_size = video_stat.st_size
         
         # ============================================
-        # 10. Calculate Metrics
+        # 9. Upload to S3 (reusing the early upload if one started)
         # ============================================
+        with uploads_lock:
+            upload = uploads.get(video_filename)
+            if upload is None:
+                logger.info("Uploading video to S3: %s", video_path)
+                upload = uploads[video_filename] = _upload_executor.submit(
+                    s3_manager.upload_file,
+                    video_path,
+                    S3_VIDEO_KEY_FMT % (job_id, video_filename)
+                )
+        
+        logger.info("Waiting for S3 upload: %s", video_path)
+        video_url = upload.result()
+        logger.info("Video uploaded successfully: %s", video_url)
+        returned_video = video_filename
         processing_time = time.time() - start_time
-        file_size = video_path.stat().st_size
         
         # ============================================
-        # 11. Return Success Response
+        # 10. Return Success Response
         # ============================================
         response = {
             "status": "success",
             "output": {
                 "video_url": video_url,
-                "duration": get_duration_from_audio(audio_path),
+                "duration": audio_duration,
                 "fps": fps,
                 "frames": num_frames,
                 "resolution": f"{width}x{height}",
@@ -226,11 +500,11 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
             }
         }
         
-        logger.info(f"Job {job_id} completed successfully in {processing_time:.2f}s")
+        logger.info("Job %s completed successfully in %.2fs", job_id, processing_time)
         return response
         
     except Exception as e:
-        logger.exception(f"Job {job_id} failed with exception")
+        logger.exception("Job %s failed with exception", job_id)
         return {
             "status": "error",
             "error": str(e),
@@ -238,18 +512,44 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         }
     
     finally:
-        # Cleanup temporary files
-        try:
-            if audio_path and audio_path.exists():
-                audio_path.unlink()
-            if reference_image_path and reference_image_path.exists():
-                reference_image_path.unlink()
-            logger.info("Temporary files cleaned up")
-        except Exception as e:
-            logger.warning(f"Cleanup error: {e}")
+        # Failed jobs must not leave objects behind under their key
+        with uploads_lock:
+            uploads_closed.set()
+            discarded = [(name, up) for name, up in uploads.items() if name != returned_video]
+        for filename, upload in discarded:
+            _discard_upload(upload, S3_VIDEO_KEY_FMT % (job_id, filename))
+        
+        # Cleanup temporary files off the response path
+        _cleanup_executor.submit(_cleanup, audio_path, reference_image_path)
+
+
+async def concurrent_handler(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run handler on the job executor
+    
+    RunPod calls synchronous handlers on its event loop, so jobs can only
+    overlap when the handler is awaitable.
+    
+    Args:
+        job: RunPod job dictionary containing input parameters
+        
+    Returns:
+        Dictionary with status and output/error
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_job_executor, handler, job)
 
 
 if __name__ == "__main__":
+    # Fail at start-up, not on the first job, if the workflow template is broken
+    _load_workflow_template()
+    
     # Start RunPod serverless worker
-    logger.info("Starting RunPod serverless worker...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    logger.info("Starting RunPod serverless worker (max concurrent jobs: %s)...", MAX_CONCURRENT_JOBS)
+    if MAX_CONCURRENT_JOBS > 1:
+        runpod.serverless.start({
+            "handler": concurrent_handler,
+            "concurrency_modifier": lambda current: MAX_CONCURRENT_JOBS
+        })
+    else:
+        runpod.serverless.start({"handler": handler})
\ No newline at end of file
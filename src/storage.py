@@ -9,16 +9,41 @@ Author: Hồ Mạnh Linh
 import boto3
 import os
 import logging
+import mimetypes
 from pathlib import Path
 from typing import Optional
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
+MB = 1024 * 1024
+
+# Multipart transfer tuning; parts above the threshold upload in parallel
+S3_MULTIPART_THRESHOLD_MB = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8'))
+S3_MULTIPART_CHUNK_MB = int(os.getenv('S3_MULTIPART_CHUNK_MB', '16'))
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '10'))
+
 
 class S3StorageManager:
     """Manager for S3-compatible storage operations"""
     
+    # Content types for the files this worker uploads; others go through mimetypes
+    _CONTENT_TYPES = {
+        '.mp4': 'video/mp4',
+        '.avi': 'video/x-msvideo',
+        '.mov': 'video/quicktime',
+        '.webm': 'video/webm',
+        '.mp3': 'audio/mpeg',
+        '.wav': 'audio/wav',
+        '.jpg': 'image/jpeg',
+        '.jpeg': 'image/jpeg',
+        '.png': 'image/png',
+        '.gif': 'image/gif',
+        '.json': 'application/json',
+        '.txt': 'text/plain'
+    }
+    
     def __init__(
         self,
         bucket_name: Optional[str] = None,
@@ -53,7 +78,15 @@ class S3StorageManager:
             region_name=self.region_name
         )
         
-        logger.info(f"S3 Storage Manager initialized: bucket={self.bucket_name}, region={self.region_name}")
+        # Multipart transfer settings for large video uploads
+        self._transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD_MB * MB,
+            multipart_chunksize=S3_MULTIPART_CHUNK_MB * MB,
+            max_concurrency=S3_MAX_CONCURRENCY,
+            use_threads=True
+        )
+        
+        logger.info("S3 Storage Manager initialized: bucket=%s, region=%s", self.bucket_name, self.region_name)
     
     def upload_file(
         self,
@@ -73,7 +106,7 @@ class S3StorageManager:
             Public URL of uploaded file
         """
         try:
-            logger.info(f"Uploading {file_path} to s3://{self.bucket_name}/{s3_key}")
+            logger.info("Uploading %s to s3://%s/%s", file_path, self.bucket_name, s3_key)
             
             # Default extra args
             if extra_args is None:
@@ -90,16 +123,17 @@ class S3StorageManager:
                 str(file_path),
                 self.bucket_name,
                 s3_key,
-                ExtraArgs=extra_args
+                ExtraArgs=extra_args,
+                Config=self._transfer_config
             )
             
             # Generate public URL
             url = self._generate_url(s3_key)
-            logger.info(f"Upload successful: {url}")
+            logger.info("Upload successful: %s", url)
             return url
             
         except ClientError as e:
-            logger.error(f"S3 upload failed: {e}")
+            logger.error("S3 upload failed: %s", e)
             raise
     
     def download_file(
@@ -118,7 +152,7 @@ class S3StorageManager:
             Path to downloaded file
         """
         try:
-            logger.info(f"Downloading s3://{self.bucket_name}/{s3_key} to {local_path}")
+            logger.info("Downloading s3://%s/%s to %s", self.bucket_name, s3_key, local_path)
             
             # Create parent directories
             local_path.parent.mkdir(parents=True, exist_ok=True)
@@ -127,14 +161,15 @@ class S3StorageManager:
             self.s3_client.download_file(
                 self.bucket_name,
                 s3_key,
-                str(local_path)
+                str(local_path),
+                Config=self._transfer_config
             )
             
-            logger.info(f"Download successful: {local_path}")
+            logger.info("Download successful: %s", local_path)
             return local_path
             
         except ClientError as e:
-            logger.error(f"S3 download failed: {e}")
+            logger.error("S3 download failed: %s", e)
             raise
     
     def delete_file(self, s3_key: str) -> bool:
@@ -148,18 +183,18 @@ class S3StorageManager:
             True if successful
         """
         try:
-            logger.info(f"Deleting s3://{self.bucket_name}/{s3_key}")
+            logger.info("Deleting s3://%s/%s", self.bucket_name, s3_key)
             
             self.s3_client.delete_object(
                 Bucket=self.bucket_name,
                 Key=s3_key
             )
             
-            logger.info(f"Delete successful: {s3_key}")
+            logger.info("Delete successful: %s", s3_key)
             return True
             
         except ClientError as e:
-            logger.error(f"S3 delete failed: {e}")
+            logger.error("S3 delete failed: %s", e)
             raise
     
     def file_exists(self, s3_key: str) -> bool:
@@ -199,8 +234,8 @@ class S3StorageManager:
             # Standard AWS S3
             return f"https://{self.bucket_name}.s3.{self.region_name}.amazonaws.com/{s3_key}"
     
-    @staticmethod
-    def _get_content_type(file_path: Path) -> Optional[str]:
+    @classmethod
+    def _get_content_type(cls, file_path: Path) -> Optional[str]:
         """
         Get content type based on file extension
         
@@ -210,21 +245,7 @@ class S3StorageManager:
         Returns:
             Content type string or None
         """
-        extension = file_path.suffix.lower()
-        
-        content_types = {
-            '.mp4': 'video/mp4',
-            '.avi': 'video/x-msvideo',
-            '.mov': 'video/quicktime',
-            '.webm': 'video/webm',
-            '.mp3': 'audio/mpeg',
-            '.wav': 'audio/wav',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.json': 'application/json',
-            '.txt': 'text/plain'
-        }
-        
-        return content_types.get(extension)
\ No newline at end of file
+        return (
+            cls._CONTENT_TYPES.get(file_path.suffix.lower())
+            or mimetypes.guess_type(file_path.name)[0]
+        )
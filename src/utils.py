@@ -7,15 +7,52 @@ Author: Hồ Mạnh Linh
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import contextlib
+import functools
+import hashlib
 import logging
 import os
+import shutil
 import subprocess
+import uuid
+import wave
 from pathlib import Path
 from typing import Dict, Any, Optional
 import mimetypes
 
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
 logger = logging.getLogger(__name__)
 
+# Download tuning
+CONNECT_TIMEOUT = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RETRY_STATUS_CODES = (502, 503, 504)
+CACHE_MAX_ENTRIES = 256
+
+# Input validation rules (built once at import)
+URL_PREFIXES = ('http://', 'https://')
+NUMERIC_TYPES = (int, float)
+NUMERIC_FIELD_CHECKS = (
+    ('num_frames', 1, 1000),
+    ('fps', 1, 60),
+    ('width', 64, 2048),
+    ('height', 64, 2048),
+    ('cfg_scale', 1.0, 30.0),
+    ('steps', 1, 150),
+    ('seed', -1, 2147483647)
+)
+
+
+_logging_configured = False
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
 
 def setup_logging(
     level: str = "INFO",
@@ -24,6 +61,10 @@ def setup_logging(
     """
     Setup logging configuration
     
+    Only the first call configures logging; later calls return the logger.
+    The format uses no caller, thread or process fields, so collecting
+    them for each record is turned off.
+    
     Args:
         level: Logging level (DEBUG, INFO, WARNING, ERROR)
         log_file: Optional log file path
@@ -31,30 +72,91 @@ def setup_logging(
     Returns:
         Configured logger
     """
+    global _logging_configured
+    
+    if _logging_configured:
+        return logging.getLogger(__name__)
+    
     log_level = getattr(logging, level.upper(), logging.INFO)
     
-    # Configure root logger
+    # Configure root logger, replacing handlers installed by imported libraries
     logging.basicConfig(
         level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
+        format=LOG_FORMAT,
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True
     )
     
     # Add file handler if specified
     if log_file:
         file_handler = logging.FileHandler(log_file)
-        file_handler.setFormatter(
-            logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        )
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
         logging.getLogger().addHandler(file_handler)
     
+    # Skip the stack walk and thread/process lookups done for every record
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    
+    _logging_configured = True
     return logging.getLogger(__name__)
 
 
+def create_http_session(
+    pool_connections: int = 4,
+    pool_maxsize: int = 16,
+    retries: int = 3
+) -> requests.Session:
+    """
+    Create a requests session with a pooled, retrying HTTP adapter
+    
+    Args:
+        pool_connections: Number of per-host connection pools to cache
+        pool_maxsize: Maximum connections kept alive per host
+        retries: Retry attempts for failed connections
+        
+    Returns:
+        Configured session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=RETRY_STATUS_CODES
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+_default_session: Optional[requests.Session] = None
+
+
+def get_default_session() -> requests.Session:
+    """
+    Get the shared session used when a caller does not pass one
+    
+    Returns:
+        Module-wide pooled session, created on first use
+    """
+    global _default_session
+    
+    if _default_session is None:
+        _default_session = create_http_session()
+    return _default_session
+
+
 def download_file(
     url: str,
     output_path: Path,
-    timeout: int = 120
+    timeout: int = 120,
+    session: Optional[requests.Session] = None
 ) -> Path:
     """
     Download file from URL
@@ -62,37 +164,129 @@ def download_file(
     Args:
         url: File URL
         output_path: Local output path
-        timeout: Download timeout in seconds
+        timeout: Read timeout in seconds
+        session: Session to download with (defaults to the shared session)
         
     Returns:
         Path to downloaded file
     """
-    logger.info(f"Downloading {url} to {output_path}")
+    logger.info("Downloading %s to %s", url, output_path)
     
     try:
         # Create parent directories
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # Download with streaming
-        response = requests.get(url, stream=True, timeout=timeout)
-        response.raise_for_status()
-        
-        # Write to file
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        # Download with streaming into a temporary file, then move into place
+        # atomically so readers never see a partially written file
+        part_path = output_path.with_name(f"{output_path.name}.{uuid.uuid4().hex[:8]}.part")
+        http = session or get_default_session()
+        try:
+            with http.get(url, stream=True, timeout=(CONNECT_TIMEOUT, timeout)) as response:
+                response.raise_for_status()
+                
+                # Copy the raw stream in large blocks; let urllib3 undo
+                # any Content-Encoding
+                response.raw.decode_content = True
+                with open(part_path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+            
+            os.replace(part_path, output_path)
+        except BaseException:
+            if part_path.exists():
+                part_path.unlink()
+            raise
         
         file_size = output_path.stat().st_size
-        logger.info(f"Download complete: {output_path} ({file_size} bytes)")
+        logger.info("Download complete: %s (%s bytes)", output_path, file_size)
         
         return output_path
         
     except requests.exceptions.RequestException as e:
-        logger.error(f"Download failed: {e}")
+        logger.error("Download failed: %s", e)
         raise
 
 
+def download_file_cached(
+    url: str,
+    output_path: Path,
+    cache_dir: Path,
+    timeout: int = 120,
+    session: Optional[requests.Session] = None,
+    max_entries: int = CACHE_MAX_ENTRIES
+) -> Path:
+    """
+    Download file from URL through a local cache keyed by URL
+    
+    The cached copy is hard-linked to output_path, so deleting output_path
+    later leaves the cache intact. Hits refresh the entry's mtime; once the
+    cache holds more than max_entries files the least recently used are
+    evicted. Entries are never revalidated, so only URLs whose content does
+    not change should be cached.
+    
+    Args:
+        url: File URL
+        output_path: Local output path
+        cache_dir: Directory holding cached downloads
+        timeout: Read timeout in seconds
+        session: Optional session to reuse pooled connections
+        max_entries: Maximum number of files kept in cache_dir
+        
+    Returns:
+        Path to downloaded file
+    """
+    url_hash = hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
+    cached_path = cache_dir / f"{url_hash}{output_path.suffix}"
+    
+    try:
+        os.utime(cached_path)
+        logger.info("Cache hit for %s: %s", url, cached_path)
+        hit = True
+    except FileNotFoundError:
+        download_file(url, cached_path, timeout=timeout, session=session)
+        hit = False
+    
+    try:
+        os.link(cached_path, output_path)
+    except OSError:
+        shutil.copyfile(cached_path, output_path)
+    
+    if not hit:
+        _evict_cache(cache_dir, max_entries)
+    
+    return output_path
+
+
+def _evict_cache(cache_dir: Path, max_entries: int) -> None:
+    """
+    Remove the least recently used files beyond max_entries
+    
+    Args:
+        cache_dir: Directory holding cached downloads
+        max_entries: Number of files to keep
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            # In-flight downloads (*.part) belong to other jobs
+            if entry.name.endswith('.part'):
+                continue
+            # Files removed by a concurrent eviction are skipped
+            with contextlib.suppress(FileNotFoundError):
+                if entry.is_file():
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+    
+    if len(entries) <= max_entries:
+        return
+    
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+        except OSError as e:
+            logger.warning("Cache eviction error: %s", e)
+
+
 def validate_input(job_input: Dict[str, Any]) -> Optional[str]:
     """
     Validate job input parameters
@@ -117,39 +311,126 @@ def validate_input(job_input: Dict[str, Any]) -> Optional[str]:
     
     # Validate audio_url
     audio_url = job_input['audio_url']
-    if not isinstance(audio_url, str) or not audio_url.startswith(('http://', 'https://')):
+    if not isinstance(audio_url, str) or not audio_url.startswith(URL_PREFIXES):
         return "'audio_url' must be a valid HTTP(S) URL"
     
     # Validate optional numeric fields
-    numeric_fields = {
-        'num_frames': (1, 1000),
-        'fps': (1, 60),
-        'width': (64, 2048),
-        'height': (64, 2048),
-        'cfg_scale': (1.0, 30.0),
-        'steps': (1, 150),
-        'seed': (-1, 2147483647)
-    }
-    
-    for field, (min_val, max_val) in numeric_fields.items():
-        if field in job_input:
-            value = job_input[field]
-            if not isinstance(value, (int, float)):
-                return f"'{field}' must be a number"
-            if not (min_val <= value <= max_val):
-                return f"'{field}' must be between {min_val} and {max_val}"
+    for field, min_val, max_val in NUMERIC_FIELD_CHECKS:
+        if field not in job_input:
+            continue
+        value = job_input[field]
+        # Exact type check: also rejects bools, which subclass int
+        if type(value) not in NUMERIC_TYPES:
+            return f"'{field}' must be a number"
+        if not (min_val <= value <= max_val):
+            return f"'{field}' must be between {min_val} and {max_val}"
     
     # Validate reference_image_url if provided
     if 'reference_image_url' in job_input:
         ref_url = job_input['reference_image_url']
         if ref_url and not isinstance(ref_url, str):
             return "'reference_image_url' must be a string"
-        if ref_url and not ref_url.startswith(('http://', 'https://')):
+        if ref_url and not ref_url.startswith(URL_PREFIXES):
             return "'reference_image_url' must be a valid HTTP(S) URL"
     
     return None
 
 
+def summarize_input(
+    job_input: Dict[str, Any],
+    max_length: int = 200
+) -> Dict[str, Any]:
+    """
+    Build a log-friendly view of the job input
+    
+    Data URIs and long strings are replaced by their size so large payloads
+    are never serialized into the logs.
+    
+    Args:
+        job_input: Job input dictionary
+        max_length: Longest string value logged verbatim
+        
+    Returns:
+        Summary dictionary
+    """
+    summary = {}
+    for key, value in job_input.items():
+        if isinstance(value, str) and value.startswith('data:'):
+            summary[key] = f"<{len(value)}B data-uri>"
+        elif isinstance(value, str) and len(value) > max_length:
+            summary[key] = f"<{len(value)} chars>"
+        else:
+            summary[key] = value
+    return summary
+
+
+def _read_header_duration(audio_file: str) -> Optional[float]:
+    """
+    Read audio duration from the container header without decoding samples
+    
+    WAV is handled by the standard library; other formats go through
+    libsndfile when soundfile is installed.
+    
+    Args:
+        audio_file: Path to audio file
+        
+    Returns:
+        Duration in seconds, or None if the header could not be read
+    """
+    try:
+        with wave.open(audio_file, 'rb') as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError, ZeroDivisionError):
+        pass
+    
+    if soundfile is not None:
+        try:
+            return soundfile.info(audio_file).duration
+        except RuntimeError:
+            pass
+    
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _probe_duration(audio_file: str, mtime_ns: int, size: int) -> float:
+    """
+    Get the duration of an audio file
+    
+    The container header is tried first; ffprobe is only spawned for
+    formats it cannot read. Cached per (path, mtime, size) so an unchanged
+    file is probed once.
+    
+    Args:
+        audio_file: Path to audio file
+        mtime_ns: File modification time (cache key only)
+        size: File size in bytes (cache key only)
+        
+    Returns:
+        Duration in seconds
+    """
+    duration = _read_header_duration(audio_file)
+    if duration:
+        return duration
+    
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        audio_file
+    ]
+    
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    
+    return float(result.stdout.strip())
+
+
 def get_duration_from_audio(audio_path: Path) -> float:
     """
     Get duration of audio file in seconds
@@ -161,28 +442,13 @@ def get_duration_from_audio(audio_path: Path) -> float:
         Duration in seconds
     """
     try:
-        # Use ffprobe to get duration
-        cmd = [
-            'ffprobe',
-            '-v', 'error',
-            '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(audio_path)
-        ]
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        duration = float(result.stdout.strip())
-        logger.info(f"Audio duration: {duration}s")
+        stat = os.stat(audio_path)
+        duration = _probe_duration(str(audio_path), stat.st_mtime_ns, stat.st_size)
+        logger.info("Audio duration: %ss", duration)
         return duration
         
-    except (subprocess.CalledProcessError, ValueError) as e:
-        logger.warning(f"Failed to get audio duration: {e}, using default 5.0s")
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        logger.warning("Failed to get audio duration: %s, using default 5.0s", e)
         return 5.0
 
 
@@ -202,7 +468,7 @@ def calculate_num_frames(duration: float, fps: int = 24) -> int:
     # Clamp to reasonable values
     num_frames = max(24, min(num_frames, 1000))
     
-    logger.info(f"Calculated {num_frames} frames for {duration}s @ {fps}fps")
+    logger.info("Calculated %s frames for %ss @ %sfps", num_frames, duration, fps)
     return num_frames
 
 
@@ -0,0 +1,20 @@
+"""
+Shared pytest fixtures
+
+Author: Hồ Mạnh Linh
+"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+# rp_handler builds its S3 manager at import time
+os.environ.setdefault('S3_BUCKET_NAME', 'test-bucket')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def mock_boto_client():
+    """Patch boto3.client once for the whole test session"""
+    with patch('boto3.client') as mock:
+        yield mock
@@ -5,238 +5,537 @@ Author: Hồ Mạnh Linh
 """
 
 import pytest
+import asyncio
+import io
 import json
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from unittest.mock import Mock, patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import Mock, patch, MagicMock, create_autospec
 
+from src import rp_handler
 from src.rp_handler import handler
-from src.comfyui_api import ComfyUIClient
+from src.comfyui_api import ComfyUIClient, _PendingPrompt
 from src.storage import S3StorageManager
 from src.utils import (
     validate_input,
     calculate_num_frames,
     get_duration_from_audio,
-    download_file
+    download_file,
+    download_file_cached
 )
 
+WORKFLOW_TEMPLATE_PATH = Path(__file__).parent.parent / 'workflows' / 'ltx2_i2v_lipsync.json'
+# Read once per session; parametrized cases share these objects
+WORKFLOW_TEMPLATE = WORKFLOW_TEMPLATE_PATH.read_bytes()
+AUDIO_URL = 'https://example.com/audio.mp3'
+VALID_INPUT = {'prompt': 'A woman talking about AI', 'audio_url': AUDIO_URL}
 
-class TestInputValidation:
+
+# ============================================
+# Input validation
+# ============================================
+
+@pytest.mark.parametrize('job_input,error_field', [
+    (VALID_INPUT, None),
+    ({'audio_url': AUDIO_URL}, 'prompt'),
+    ({'prompt': 'A beautiful woman talking'}, 'audio_url'),
+    ({'prompt': 'Test', 'audio_url': 'not-a-valid-url'}, 'audio_url'),
+    ({'prompt': 'Test', 'audio_url': AUDIO_URL, 'num_frames': 2000}, 'num_frames'),
+    ({'prompt': 'Test', 'audio_url': AUDIO_URL, 'steps': True}, 'steps'),
+], ids=['valid', 'missing_prompt', 'missing_audio_url', 'invalid_audio_url', 'num_frames_too_high', 'boolean_steps'])
+def test_validate_input(job_input, error_field):
     """Test input validation"""
+    error = validate_input(job_input)
     
-    def test_valid_input(self):
-        """Test valid input passes validation"""
-        job_input = {
-            'prompt': 'A beautiful woman talking',
-            'audio_url': 'https://example.com/audio.mp3'
-        }
-        
-        error = validate_input(job_input)
+    if error_field is None:
         assert error is None
+    else:
+        assert error is not None and error_field in error
+
+
+# ============================================
+# Utility functions
+# ============================================
+
+@pytest.mark.parametrize('duration,fps,expected', [
+    (5.0, 24, 120),
+    (10.0, 30, 300),
+    (0.5, 24, 24),      # Too low - clamped to 24
+    (100.0, 24, 1000),  # Too high - clamped to 1000
+], ids=['5s@24fps', '10s@30fps', 'clamp_low', 'clamp_high'])
+def test_calculate_num_frames(duration, fps, expected):
+    """Test frame calculation and clamping"""
+    assert calculate_num_frames(duration, fps) == expected
+
+
+@patch('src.utils.subprocess.run')
+def test_get_duration_from_audio_cached(mock_run, tmp_path):
+    """Test an unchanged file is probed only once"""
+    mock_run.return_value.stdout = '4.5\n'
+    audio_path = tmp_path / 'audio.mp3'
+    audio_path.write_bytes(b'audio')
     
-    def test_missing_prompt(self):
-        """Test missing prompt fails validation"""
-        job_input = {
-            'audio_url': 'https://example.com/audio.mp3'
-        }
-        
-        error = validate_input(job_input)
-        assert error is not None
-        assert 'prompt' in error
-    
-    def test_missing_audio_url(self):
-        """Test missing audio_url fails validation"""
-        job_input = {
-            'prompt': 'A beautiful woman talking'
-        }
-        
-        error = validate_input(job_input)
-        assert error is not None
-        assert 'audio_url' in error
-    
-    def test_invalid_audio_url(self):
-        """Test invalid audio URL fails validation"""
-        job_input = {
-            'prompt': 'Test',
-            'audio_url': 'not-a-valid-url'
-        }
-        
-        error = validate_input(job_input)
-        assert error is not None
-    
-    def test_numeric_field_validation(self):
-        """Test numeric field validation"""
-        job_input = {
-            'prompt': 'Test',
-            'audio_url': 'https://example.com/audio.mp3',
-            'num_frames': 2000  # Too high
-        }
-        
-        error = validate_input(job_input)
-        assert error is not None
-        assert 'num_frames' in error
+    assert get_duration_from_audio(audio_path) == 4.5
+    assert get_duration_from_audio(audio_path) == 4.5
+    assert mock_run.call_count == 1
 
 
-class TestUtilityFunctions:
-    """Test utility functions"""
+@patch('src.utils.subprocess.run')
+def test_get_duration_from_wav_header(mock_run, tmp_path):
+    """Test WAV duration is read from the header without ffprobe"""
+    audio_path = tmp_path / 'audio.wav'
+    with wave.open(str(audio_path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(b'\x00\x00' * 24000)
     
-    def test_calculate_num_frames(self):
-        """Test frame calculation"""
-        # 5 seconds at 24fps = 120 frames
-        frames = calculate_num_frames(5.0, 24)
-        assert frames == 120
-        
-        # 10 seconds at 30fps = 300 frames
-        frames = calculate_num_frames(10.0, 30)
-        assert frames == 300
-    
-    def test_calculate_num_frames_clamping(self):
-        """Test frame clamping"""
-        # Too low - should clamp to 24
-        frames = calculate_num_frames(0.5, 24)
-        assert frames >= 24
-        
-        # Too high - should clamp to 1000
-        frames = calculate_num_frames(100.0, 24)
-        assert frames <= 1000
-
-
-class TestComfyUIClient:
-    """Test ComfyUI API client"""
-    
-    @patch('requests.Session')
-    def test_client_initialization(self, mock_session):
-        """Test client initialization"""
-        client = ComfyUIClient('http://localhost:8188')
-        assert client.base_url == 'http://localhost:8188'
-    
-    @patch('requests.Session')
-    def test_queue_prompt(self, mock_session):
-        """Test queueing a prompt"""
-        mock_response = Mock()
-        mock_response.json.return_value = {'prompt_id': 'test-123'}
-        mock_response.raise_for_status = Mock()
-        
-        mock_session.return_value.request.return_value = mock_response
-        
-        client = ComfyUIClient()
-        workflow = {"test": "workflow"}
-        
-        prompt_id = client.queue_prompt(workflow)
-        assert prompt_id == 'test-123'
-    
-    @patch('requests.Session')
-    def test_health_check(self, mock_session):
-        """Test health check"""
-        mock_response = Mock()
-        mock_response.json.return_value = {'status': 'ok'}
-        mock_response.raise_for_status = Mock()
-        
-        mock_session.return_value.request.return_value = mock_response
-        
-        client = ComfyUIClient()
-        is_healthy = client.health_check()
-        assert is_healthy is True
-
-
-class TestS3StorageManager:
-    """Test S3 storage manager"""
-    
-    @patch('boto3.client')
-    def test_initialization(self, mock_boto_client):
-        """Test S3 manager initialization"""
-        manager = S3StorageManager(
-            bucket_name='test-bucket',
-            aws_access_key_id='test-key',
-            aws_secret_access_key='test-secret'
-        )
-        
-        assert manager.bucket_name == 'test-bucket'
-    
-    @patch('boto3.client')
-    def test_generate_url(self, mock_boto_client):
-        """Test URL generation"""
-        manager = S3StorageManager(
-            bucket_name='test-bucket',
-            region_name='us-east-1'
-        )
-        
-        url = manager._generate_url('videos/test.mp4')
-        assert 'test-bucket' in url
-        assert 'test.mp4' in url
-
-
-class TestHandler:
-    """Test main handler function"""
-    
-    @patch('src.rp_handler.comfyui_client')
-    @patch('src.rp_handler.s3_manager')
-    @patch('src.utils.download_file')
-    @patch('src.utils.get_duration_from_audio')
-    def test_handler_success(
-        self,
-        mock_get_duration,
-        mock_download,
-        mock_s3,
-        mock_comfyui
-    ):
-        """Test successful handler execution"""
-        # Setup mocks
-        mock_get_duration.return_value = 5.0
-        mock_download.return_value = Path('/tmp/audio.mp3')
-        
-        mock_comfyui.queue_prompt.return_value = 'prompt-123'
-        mock_comfyui.wait_for_completion.return_value = (
-            True,
-            {
-                'outputs': {
-                    'video': {
-                        'filename': 'output.mp4'
-                    }
-                }
-            }
-        )
-        
-        mock_s3.upload_file.return_value = 'https://s3.amazonaws.com/bucket/video.mp4'
+    assert get_duration_from_audio(audio_path) == 1.5
+    mock_run.assert_not_called()
+
+
+def test_download_file_streams_raw_body(tmp_path):
+    """Test downloads copy the raw response stream into place"""
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.raw = io.BytesIO(b'audio-bytes')
+    session = Mock()
+    session.get.return_value = response
+    
+    output_path = tmp_path / 'audio.mp3'
+    result = download_file(AUDIO_URL, output_path, session=session)
+    
+    assert result == output_path
+    assert output_path.read_bytes() == b'audio-bytes'
+    assert response.raw.decode_content is True
+    assert list(tmp_path.iterdir()) == [output_path]
+
+
+@patch('src.utils.download_file')
+def test_download_file_cached_hit(mock_download, tmp_path):
+    """Test cached downloads are linked without re-downloading"""
+    url = 'https://example.com/face.jpg'
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    
+    # Populate the cache through a first (mocked) download
+    mock_download.side_effect = lambda url, path, **kwargs: path.write_bytes(b'image')
+    download_file_cached(url, tmp_path / 'job1.jpg', cache_dir)
+    
+    result = download_file_cached(url, tmp_path / 'job2.jpg', cache_dir)
+    
+    assert mock_download.call_count == 1
+    assert result.read_bytes() == b'image'
+
+
+def test_download_file_cached_evicts_least_recently_used(tmp_path):
+    """Test the cache keeps at most max_entries files, dropping the oldest"""
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    
+    with patch('src.utils.download_file') as mock_download:
+        mock_download.side_effect = lambda url, path, **kwargs: path.write_bytes(url.encode())
+        for i in range(3):
+            result = download_file_cached(f'https://example.com/{i}.jpg', tmp_path / f'job{i}.jpg', cache_dir)
+            # The result is hard-linked to its cache entry; pin distinct mtimes
+            os.utime(result, ns=(i * 10**9, i * 10**9))
         
-        # Mock file existence
-        with patch('pathlib.Path.exists', return_value=True):
-            with patch('pathlib.Path.stat') as mock_stat:
-                mock_stat.return_value.st_size = 15728640
-                
-                # Test job
-                job = {
-                    'id': 'test-job-123',
-                    'input': {
-                        'prompt': 'A woman talking about AI',
-                        'audio_url': 'https://example.com/audio.mp3'
-                    }
-                }
-                
-                # Mock workflow file
-                with patch('builtins.open', create=True) as mock_open:
-                    mock_open.return_value.__enter__.return_value.read.return_value = '{}'
-                    
-                    result = handler(job)
+        # Another job's download in progress, older than every entry
+        in_flight = cache_dir / 'other.jpg.1a2b3c4d.part'
+        in_flight.write_bytes(b'partial')
+        os.utime(in_flight, ns=(0, 0))
         
-        # Assertions
-        assert result['status'] == 'success'
-        assert 'output' in result
-        assert 'video_url' in result['output']
-    
-    def test_handler_validation_error(self):
-        """Test handler with invalid input"""
-        job = {
-            'id': 'test-job-456',
-            'input': {
-                # Missing required fields
-            }
+        download_file_cached('https://example.com/3.jpg', tmp_path / 'job3.jpg', cache_dir, max_entries=3)
+    
+    assert in_flight.exists()
+    in_flight.unlink()
+    cached = {path.read_bytes() for path in cache_dir.iterdir()}
+    assert cached == {b'https://example.com/1.jpg', b'https://example.com/2.jpg', b'https://example.com/3.jpg'}
+
+
+# ============================================
+# ComfyUI API client
+# ============================================
+
+@pytest.fixture
+def mock_session():
+    """Patch requests.Session so ComfyUIClient gets a mock session"""
+    with patch('requests.Session') as mock:
+        yield mock
+
+
+@pytest.fixture(scope='module')
+def make_response():
+    """Build mock HTTP responses returning the given JSON payload"""
+    def _make_response(payload):
+        response = Mock(spec=['json', 'raise_for_status'])
+        response.json.return_value = payload
+        return response
+    return _make_response
+
+
+def test_client_initialization(mock_session):
+    """Test client initialization"""
+    client = ComfyUIClient('http://localhost:8188')
+    assert client.base_url == 'http://localhost:8188'
+
+
+def test_queue_prompt(mock_session, make_response):
+    """Test queueing a prompt"""
+    mock_session.return_value.request.return_value = make_response({'prompt_id': 'test-123'})
+    
+    client = ComfyUIClient()
+    workflow = {"test": "workflow"}
+    
+    prompt_id = client.queue_prompt(workflow)
+    assert prompt_id == 'test-123'
+    
+    kwargs = mock_session.return_value.request.call_args.kwargs
+    assert json.loads(kwargs['data'])['prompt'] == workflow
+    assert kwargs['headers'] == {'Content-Type': 'application/json'}
+
+
+@patch('src.comfyui_api.ws_connect')
+def test_queue_prompt_falls_back_when_websocket_fails(mock_connect, mock_session, make_response):
+    """Test a WebSocket connect error leaves the client in polling mode"""
+    mock_connect.side_effect = ConnectionRefusedError(111, 'Connection refused')
+    mock_session.return_value.request.return_value = make_response({'prompt_id': 'test-123'})
+    
+    client = ComfyUIClient()
+    
+    assert client.queue_prompt({"test": "workflow"}) == 'test-123'
+    assert client._ws is None
+    assert client._pending == {}
+
+
+def test_health_check(mock_session, make_response):
+    """Test health check"""
+    mock_session.return_value.request.return_value = make_response({'status': 'ok'})
+    
+    client = ComfyUIClient()
+    is_healthy = client.health_check()
+    assert is_healthy is True
+
+
+def test_wait_for_completion_websocket(mock_session, make_response):
+    """Test completion detected from WebSocket events"""
+    mock_session.return_value.request.return_value = make_response({'prompt-123': {'outputs': {}}})
+    
+    client = ComfyUIClient()
+    client._pending['prompt-123'] = _PendingPrompt()
+    client._dispatch({'type': 'executing', 'data': {'node': '8', 'prompt_id': 'prompt-123'}})
+    client._dispatch({'type': 'executing', 'data': {'node': None, 'prompt_id': 'prompt-123'}})
+    
+    success, result = client.wait_for_completion('prompt-123', timeout=10)
+    assert success is True
+    assert 'outputs' in result
+    assert client._pending == {}
+
+
+def test_wait_for_completion_uses_executed_outputs(mock_session):
+    """Test outputs from 'executed' events skip the history request"""
+    client = ComfyUIClient()
+    client._pending['prompt-123'] = _PendingPrompt()
+    client._dispatch({
+        'type': 'executed',
+        'data': {
+            'node': '13',
+            'prompt_id': 'prompt-123',
+            'output': {'videos': [{'filename': 'out.mp4', 'subfolder': ''}]}
         }
-        
-        result = handler(job)
-        
-        assert result['status'] == 'error'
+    })
+    client._dispatch({'type': 'executing', 'data': {'node': None, 'prompt_id': 'prompt-123'}})
+    
+    on_output = Mock()
+    success, result = client.wait_for_completion('prompt-123', timeout=10, on_output=on_output)
+    assert success is True
+    assert result['outputs']['13']['videos'][0]['filename'] == 'out.mp4'
+    on_output.assert_called_once_with('13', result['outputs']['13'])
+    mock_session.return_value.request.assert_not_called()
+
+
+def test_websocket_events_routed_by_prompt_id(mock_session):
+    """Test one WebSocket serves several pending prompts"""
+    client = ComfyUIClient()
+    client._pending['prompt-a'] = _PendingPrompt()
+    client._pending['prompt-b'] = _PendingPrompt()
+    client._dispatch({
+        'type': 'execution_error',
+        'data': {'prompt_id': 'prompt-a', 'exception_message': 'OOM'}
+    })
+    client._dispatch({
+        'type': 'executed',
+        'data': {'node': '13', 'prompt_id': 'prompt-b', 'output': {'videos': []}}
+    })
+    client._dispatch({'type': 'executing', 'data': {'node': None, 'prompt_id': 'prompt-b'}})
+    
+    assert client.wait_for_completion('prompt-a', timeout=10) == (False, {'error': 'OOM'})
+    success, result = client.wait_for_completion('prompt-b', timeout=10)
+    assert success is True
+    assert list(result['outputs']) == ['13']
+
+
+def test_wait_for_completion_interrupted(mock_session):
+    """Test an interrupted prompt fails without waiting for the timeout"""
+    client = ComfyUIClient()
+    client._pending['prompt-123'] = _PendingPrompt()
+    client._dispatch({
+        'type': 'execution_interrupted',
+        'data': {'prompt_id': 'prompt-123', 'node_id': '8'}
+    })
+    
+    success, result = client.wait_for_completion('prompt-123', timeout=10)
+    assert success is False
+    assert result == {'error': 'Execution interrupted'}
+    mock_session.return_value.request.assert_not_called()
+
+
+def test_wait_for_completion_without_polling_fallback(mock_session):
+    """Test untracked prompts fail when polling fallback is disabled"""
+    client = ComfyUIClient(polling_fallback=False)
+    
+    success, result = client.wait_for_completion('prompt-123', timeout=10)
+    assert success is False
+    assert 'error' in result
+    mock_session.return_value.request.assert_not_called()
+
+
+# ============================================
+# S3 storage manager
+# ============================================
+
+def test_initialization():
+    """Test S3 manager initialization"""
+    manager = S3StorageManager(
+        bucket_name='test-bucket',
+        aws_access_key_id='test-key',
+        aws_secret_access_key='test-secret'
+    )
+    
+    assert manager.bucket_name == 'test-bucket'
+
+
+def test_generate_url():
+    """Test URL generation"""
+    manager = S3StorageManager(
+        bucket_name='test-bucket',
+        region_name='us-east-1'
+    )
+    
+    url = manager._generate_url('videos/test.mp4')
+    assert 'test-bucket' in url
+    assert 'test.mp4' in url
+
+
+def test_upload_uses_multipart_config(mock_boto_client):
+    """Test uploads pass the multipart transfer config"""
+    manager = S3StorageManager(bucket_name='test-bucket')
+    
+    manager.upload_file(Path('/tmp/output.mp4'), 'videos/output.mp4')
+    
+    kwargs = mock_boto_client.return_value.upload_file.call_args.kwargs
+    assert kwargs['Config'] is manager._transfer_config
+    assert kwargs['ExtraArgs'] == {'ContentType': 'video/mp4'}
+
+
+def test_get_content_type():
+    """Test known extensions use the table and others fall back to mimetypes"""
+    assert S3StorageManager._get_content_type(Path('out.MP4')) == 'video/mp4'
+    assert S3StorageManager._get_content_type(Path('out.mpeg')) == 'video/mpeg'
+    assert S3StorageManager._get_content_type(Path('out')) is None
+
+
+# ============================================
+# Handler
+# ============================================
+
+class FakeComfyUI:
+    """Plain stand-in for ComfyUIClient that completes every prompt"""
+    
+    outputs = {'video': {'filename': 'output.mp4'}}
+    
+    def queue_prompt(self, workflow):
+        return 'prompt-123'
+    
+    def wait_for_completion(self, prompt_id, timeout=300, check_interval=2, on_output=None):
+        if on_output is not None:
+            for node_id, output in self.outputs.items():
+                on_output(node_id, output)
+        return True, {'outputs': self.outputs}
+
+
+@pytest.fixture(scope='session')
+def workflow_file(tmp_path_factory):
+    """Copy of the workflow template on disk, written once per session"""
+    path = tmp_path_factory.mktemp('wf') / 'workflow.json'
+    path.write_bytes(WORKFLOW_TEMPLATE)
+    return path
+
+
+@pytest.fixture(scope='module')
+def _handler_patches(tmp_path_factory, workflow_file):
+    """Replace the handler's external dependencies once per module"""
+    mocks = SimpleNamespace(
+        comfyui=FakeComfyUI(),
+        s3=create_autospec(S3StorageManager, instance=True, spec_set=True),
+        download=create_autospec(
+            download_file,
+            side_effect=lambda url, path, **kwargs: path.write_bytes(b'audio')
+        ),
+        get_duration=create_autospec(get_duration_from_audio, return_value=5.0)
+    )
+    mocks.s3.upload_file.return_value = 'https://s3.amazonaws.com/bucket/video.mp4'
+    
+    # Real input/output directories; the handler never deletes the output video
+    input_dir = tmp_path_factory.mktemp('input')
+    output_dir = tmp_path_factory.mktemp('output')
+    (output_dir / 'output.mp4').write_bytes(b'\0' * 4096)
+    
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(rp_handler, 'INPUT_DIR', input_dir)
+        mp.setattr(rp_handler, 'OUTPUT_DIR', output_dir)
+        mp.setattr(rp_handler, 'comfyui_client', mocks.comfyui)
+        mp.setattr(rp_handler, 's3_manager', mocks.s3)
+        mp.setattr(rp_handler, 'download_file', mocks.download)
+        mp.setattr(rp_handler, 'get_duration_from_audio', mocks.get_duration)
+        mp.setattr(rp_handler, 'WORKFLOW_PATH', workflow_file)
+        mp.setattr(rp_handler, '_workflow_template', None)
+        yield mocks
+
+
+@pytest.fixture
+def handler_mocks(_handler_patches):
+    """Module-wide handler mocks with call history cleared for each test"""
+    for mock in (_handler_patches.s3, _handler_patches.download, _handler_patches.get_duration):
+        mock.reset_mock()
+    return _handler_patches
+
+
+@pytest.mark.parametrize('job_input,status', [
+    pytest.param(VALID_INPUT, 'success', id='valid', marks=pytest.mark.slow),
+    pytest.param({}, 'error', id='missing_fields'),
+])
+def test_handler(handler_mocks, job_input, status):
+    """Test handler success and validation error paths"""
+    result = handler({'id': 'test-job-123', 'input': job_input})
+    
+    assert result['status'] == status
+    if status == 'success':
+        assert result['output']['video_url'] == 'https://s3.amazonaws.com/bucket/video.mp4'
+        assert result['output']['file_size'] == 4096
+        assert result['output']['frames'] == 120
+        # The on_output replay starts the upload early; it is not repeated
+        handler_mocks.s3.upload_file.assert_called_once()
+    else:
         assert 'error' in result
 
 
+def test_handler_discards_early_upload_on_failure(handler_mocks, monkeypatch):
+    """Test a job failing after the video was reported deletes its upload"""
+    class TimingOutComfyUI(FakeComfyUI):
+        def wait_for_completion(self, prompt_id, timeout=300, check_interval=2, on_output=None):
+            super().wait_for_completion(prompt_id, timeout, check_interval, on_output)
+            return False, {'error': 'Execution timeout'}
+    
+    monkeypatch.setattr(rp_handler, 'comfyui_client', TimingOutComfyUI())
+    
+    result = handler({'id': 'test-job-123', 'input': VALID_INPUT})
+    
+    assert result == {'status': 'error', 'error': 'Execution timeout'}
+    # The delete runs on the single-worker cleanup executor; wait for it
+    rp_handler._cleanup_executor.submit(lambda: None).result()
+    handler_mocks.s3.upload_file.assert_called_once()
+    handler_mocks.s3.delete_file.assert_called_once_with('videos/test-job-123/output.mp4')
+
+
+def test_concurrent_handler_runs_handler():
+    """Test the awaitable handler runs jobs on the job executor"""
+    job = {'id': 'test-job-789', 'input': {}}
+    
+    result = asyncio.run(rp_handler.concurrent_handler(job))
+    
+    assert result['status'] == 'error'
+    assert 'prompt' in result['error']
+
+
+def test_load_workflow_rejects_missing_nodes(tmp_path, monkeypatch):
+    """Test a template without the required nodes fails at load time"""
+    workflow_path = tmp_path / 'workflow.json'
+    workflow_path.write_text(json.dumps({'9': {'class_type': 'LoadAudio', 'inputs': {}}}))
+    monkeypatch.setattr(rp_handler, 'WORKFLOW_PATH', workflow_path)
+    monkeypatch.setattr(rp_handler, '_workflow_template', None)
+    
+    with pytest.raises(ValueError, match='CLIPTextEncode'):
+        rp_handler._load_workflow()
+
+
+def test_load_workflow_copies_updated_nodes(workflow_file, monkeypatch):
+    """Test jobs never share the nodes they write into"""
+    monkeypatch.setattr(rp_handler, 'WORKFLOW_PATH', workflow_file)
+    monkeypatch.setattr(rp_handler, '_workflow_template', None)
+    
+    first = rp_handler._load_workflow()
+    first['9']['inputs']['audio'] = '/workspace/input/job1_audio.mp3'
+    second = rp_handler._load_workflow()
+    
+    assert second['9']['inputs']['audio'] != first['9']['inputs']['audio']
+    assert second['1'] is first['1']
+
+
+def test_load_workflow_parses_once_under_concurrency(workflow_file, monkeypatch):
+    """Test concurrent first loads share one parsed template"""
+    loads = Mock(side_effect=json.loads)
+    monkeypatch.setattr(rp_handler, 'WORKFLOW_PATH', workflow_file)
+    monkeypatch.setattr(rp_handler, '_workflow_template', None)
+    monkeypatch.setattr(rp_handler, '_json_loads', loads)
+    
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        workflows = list(executor.map(lambda _: rp_handler._load_workflow(), range(8)))
+    
+    assert loads.call_count == 1
+    assert all(workflow.keys() == workflows[0].keys() for workflow in workflows)
+
+
+def test_cleanup_ignores_missing_files(tmp_path):
+    """Test cleanup removes existing files and skips missing ones"""
+    existing = tmp_path / 'job_audio.mp3'
+    existing.write_bytes(b'audio')
+    
+    rp_handler._cleanup(tmp_path / 'missing.jpg', None, existing)
+    
+    assert not existing.exists()
+
+
+def test_apply_job_params(monkeypatch):
+    """Test job parameters reach every indexed node"""
+    workflow = {
+        '2': {'class_type': 'CLIPTextEncode', 'inputs': {'text': ''}},
+        '8': {'class_type': 'LTX2VideoGeneration', 'inputs': {'fps': 24}},
+        '9': {'class_type': 'LoadAudio', 'inputs': {'audio': ''}},
+        '10': {'class_type': 'LoadImage', 'inputs': {'image': 'default.png'}}
+    }
+    monkeypatch.setattr(rp_handler, '_workflow_nodes', {
+        'CLIPTextEncode': ['2'],
+        'LTX2VideoGeneration': ['8'],
+        'LoadAudio': ['9'],
+        'LoadImage': ['10']
+    })
+    
+    rp_handler._apply_job_params(workflow, {
+        'prompt': 'A woman talking',
+        'video': {'num_frames': 120},
+        'audio': '/workspace/input/job_audio.mp3',
+        'image': None
+    })
+    
+    assert workflow['2']['inputs']['text'] == 'A woman talking'
+    assert workflow['8']['inputs'] == {'fps': 24, 'num_frames': 120}
+    assert workflow['9']['inputs']['audio'] == '/workspace/input/job_audio.mp3'
+    assert workflow['10']['inputs']['image'] == 'default.png'
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
\ No newline at end of file